@@ -2,17 +2,27 @@
 AutoLabel - ML-Assisted Data Labeling Tool
 Flask Backend with CLIP Zero-Shot Classification
 """
+import io
 import os
-import json
 import sqlite3
+import hashlib
+import queue
+import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-from PIL import Image
+from PIL import Image, ImageOps
+import numpy as np
+import orjson
 import torch
 from transformers import CLIPProcessor, CLIPModel
 
@@ -24,21 +34,127 @@ UPLOAD_FOLDER = Path("uploads")
 DB_PATH = "autolabel.db"
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "webp", "gif"}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+MAX_UPLOAD_FILES = 64  # files per upload request
+IMAGE_CACHE_SIZE = 4096  # cached image embeddings (~1KB each in FP16)
+MAX_BATCH_SIZE = 32  # images per CLIP forward pass
+PREPROC_CHUNK_SIZE = 16  # decoded images handed to CLIP at a time
+# Uploads reach the image tower in preprocessing chunks, so that is the largest batch
+ENCODE_BATCH_SIZE = min(MAX_BATCH_SIZE, PREPROC_CHUNK_SIZE)
+JPEG_DRAFT = os.environ.get("AUTOLABEL_JPEG_DRAFT", "0") == "1"  # faster, not CLIPProcessor-exact
+USE_TORCH_COMPILE = os.environ.get("AUTOLABEL_COMPILE", "1") == "1"
+USE_CUDA_GRAPHS = os.environ.get("AUTOLABEL_CUDA_GRAPHS", "1") == "1"  # GPU only
+QUANTIZE_CPU = os.environ.get("AUTOLABEL_QUANTIZE", "0") == "1"  # int8 linears, CPU only
+CPU_BF16 = os.environ.get("AUTOLABEL_CPU_BF16", "auto")  # "auto" detects AVX512-BF16/AMX
+READ_POOL_SIZE = os.cpu_count() or 4  # pooled read-only SQLite connections
+READ_POOL_TIMEOUT = 10  # seconds to wait for a free read connection
+DEFAULT_PAGE_SIZE = 100  # images per page when listing
+MAX_PAGE_SIZE = 500
+MAX_SQLITE_INT = 2 ** 63 - 1  # largest integer SQLite can bind
+EXPORT_FETCH_SIZE = 1000  # rows fetched per batch when streaming exports
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60  # uploaded files never change once written
+
+# Reject oversized requests before Flask reads the body
+app.config["MAX_CONTENT_LENGTH"] = MAX_FILE_SIZE * MAX_UPLOAD_FILES
+
+# Let a fronting web server send uploaded files (X-Sendfile)
+app.config["USE_X_SENDFILE"] = os.environ.get("AUTOLABEL_X_SENDFILE", "0") == "1"
 
 UPLOAD_FOLDER.mkdir(exist_ok=True)
 
+
+def _cpu_has_native_bf16() -> bool:
+    """Check /proc/cpuinfo for native BF16 matmul support (AVX512-BF16 or AMX)"""
+    try:
+        cpuinfo = Path("/proc/cpuinfo").read_text()
+    except OSError:
+        return False
+    return "avx512_bf16" in cpuinfo or "amx_bf16" in cpuinfo
+
+
 # Load CLIP model
 print("Loading CLIP model...")
 device = "cuda" if torch.cuda.is_available() else "cpu"
-model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(device)
+torch.set_num_threads(os.cpu_count())
+torch.set_float32_matmul_precision("high")  # allow TF32 matmuls on Ampere+
+# Half precision weights on GPU; on CPU keep FP32 weights and autocast to BF16
+# only where the hardware runs it natively (emulated BF16 is slower than FP32)
+if device == "cuda":
+    use_autocast = True
+elif CPU_BF16 == "auto":
+    use_autocast = _cpu_has_native_bf16()
+else:
+    use_autocast = CPU_BF16 == "1"
+model_dtype = torch.float16 if device == "cuda" else torch.float32
+autocast_dtype = torch.float16 if device == "cuda" else torch.bfloat16
+# Cached CLIP features are compared in FP16 on GPU (CPU half matmuls are slow)
+feature_dtype = torch.float16 if device == "cuda" else torch.float32
+model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(device, dtype=model_dtype).eval()
 processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-print(f"CLIP model loaded on {device}")
+logit_scale = model.logit_scale.exp().item()
+
+# Optional int8 dynamic quantization of the linear layers on CPU. Quantized
+# linears take FP32 inputs, so BF16 autocast and torch.compile are skipped.
+quantized = QUANTIZE_CPU and device == "cpu"
+if quantized:
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+use_autocast = use_autocast and not quantized
+
+# Compile the image tower; batches are padded to fixed buckets so graphs are reused.
+# CUDA graphs are captured by this app (see _capture_cuda_graph), not by Inductor:
+# "reduce-overhead" keeps its graph state per thread, and requests run on
+# different threads than the startup warm-up.
+use_cuda_graphs = USE_CUDA_GRAPHS and device == "cuda"
+compiled = USE_TORCH_COMPILE and not quantized
+if compiled:
+    image_encoder = torch.compile(model.get_image_features, mode="default", fullgraph=False)
+else:
+    image_encoder = model.get_image_features
+# Only compiled encoders and CUDA graphs need batches padded to fixed shapes
+fixed_shapes = compiled or use_cuda_graphs
+print(f"CLIP model loaded on {device}" + (" (int8)" if quantized else ""))
+
+# Image preprocessing constants, taken from the CLIP image processor config
+IMAGE_SIZE = processor.image_processor.crop_size["height"]
+PIXEL_MEAN = torch.tensor(processor.image_processor.image_mean).view(1, 3, 1, 1)
+PIXEL_STD = torch.tensor(processor.image_processor.image_std).view(1, 3, 1, 1)
+PIXEL_MEAN, PIXEL_STD = PIXEL_MEAN.to(device), PIXEL_STD.to(device)
+
+# Image decode/resize runs here so it overlaps with CLIP inference
+PREPROC_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Normalized text features per project (project labels never change)
+_text_feat_cache: Dict[int, torch.Tensor] = {}
+
+# Parsed labels per project, so the stored JSON is decoded once
+_project_labels: Dict[int, List[str]] = {}
+
+# Image tower CUDA graphs per batch bucket, captured at startup: (graph, static input, static output)
+_cuda_graphs: Dict[int, Tuple["torch.cuda.CUDAGraph", torch.Tensor, torch.Tensor]] = {}
+_cuda_graph_lock = threading.Lock()
+
+# LRU of normalized image features keyed by content hash, stored FP16 on CPU
+_image_feat_cache: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+_image_feat_lock = threading.Lock()
 
 
 # Database setup
+def _connect() -> sqlite3.Connection:
+    """Open a SQLite connection in WAL mode with tuned PRAGMAs"""
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+    conn.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA busy_timeout=5000;
+        PRAGMA cache_size=-20000;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA foreign_keys=ON;
+    """)
+    return conn
+
+
 def init_db():
     """Initialize SQLite database"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     
     # Projects table
@@ -66,51 +182,324 @@ def init_db():
         )
     """)
     
+    # Indexes for per-project listing (newest id first) and verification counts
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_images_project_id
+        ON images (project_id, id)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_images_project_verified
+        ON images (project_id, is_verified)
+    """)
+    
     conn.commit()
     conn.close()
 
 
 init_db()
 
+# Connection pool: one shared writer plus READ_POOL_SIZE readers (WAL lets
+# readers run concurrently with the writer)
+_writer_conn = _connect()
+_write_lock = threading.Lock()
+_read_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+for _ in range(READ_POOL_SIZE):
+    _read_pool.put(_connect())
+
+
+@contextmanager
+def _read_conn():
+    """Borrow a read connection from the pool (raises queue.Empty on timeout)"""
+    conn = _read_pool.get(timeout=READ_POOL_TIMEOUT)
+    try:
+        yield conn
+    finally:
+        _read_pool.put(conn)
+
+
+@contextmanager
+def _write_txn():
+    """Run a write transaction on the shared writer connection"""
+    with _write_lock:
+        _writer_conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield _writer_conn
+            _writer_conn.execute("COMMIT")
+        except BaseException:
+            # Also covers a failed COMMIT, so the shared connection never stays
+            # stuck inside a transaction (SQLite may already have rolled back)
+            if _writer_conn.in_transaction:
+                _writer_conn.execute("ROLLBACK")
+            raise
+
 
 def allowed_file(filename: str) -> bool:
     """Check if file extension is allowed"""
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def predict_label(image_path: str, labels: List[str]) -> Dict[str, float]:
+def is_image_header(header: bytes) -> bool:
+    """Check magic bytes for one of the allowed image formats"""
+    return (
+        header.startswith(b"\x89PNG\r\n\x1a\n")
+        or header.startswith(b"\xff\xd8\xff")
+        or header[:6] in (b"GIF87a", b"GIF89a")
+        or (header[:4] == b"RIFF" and header[8:12] == b"WEBP")
+    )
+
+
+def _parse_labels(project_id: int, labels_json: str) -> List[str]:
+    """Return a project's labels, parsing the stored JSON only on first use"""
+    labels = _project_labels.get(project_id)
+    if labels is None:
+        labels = orjson.loads(labels_json)
+        _project_labels[project_id] = labels
+    return labels
+
+
+def get_text_features(project_id: int, labels: List[str]) -> torch.Tensor:
     """
-    Use CLIP to predict label probabilities
-    Returns: {"label1": 0.8, "label2": 0.15, ...}
+    Return normalized CLIP text features for a project's labels, shape (L, D)
+    Computed once per project and cached for later uploads as a contiguous
+    feature_dtype tensor on the device.
     """
-    try:
-        image = Image.open(image_path).convert("RGB")
-        
-        # Prepare inputs
-        inputs = processor(
-            text=[f"a photo of a {label}" for label in labels],
-            images=image,
+    text_features = _text_feat_cache.get(project_id)
+    if text_features is None:
+        text_inputs = processor.tokenizer(
+            [f"a photo of a {label}" for label in labels],
             return_tensors="pt",
             padding=True
         ).to(device)
         
-        # Get predictions
-        with torch.no_grad():
-            outputs = model(**inputs)
-            logits_per_image = outputs.logits_per_image
-            probs = logits_per_image.softmax(dim=1)[0].cpu().numpy()
+        with torch.inference_mode(), torch.autocast(device_type=device, dtype=autocast_dtype, enabled=use_autocast):
+            text_features = model.get_text_features(**text_inputs).float()
+            text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+            text_features = text_features.to(feature_dtype).contiguous()
+        
+        _text_feat_cache[project_id] = text_features
+    
+    return text_features
+
+
+def load_image(data: bytes) -> Optional[np.ndarray]:
+    """
+    Decode image bytes and resize to the CLIP input size, as uint8 (H, W, 3)
+    Matches CLIPProcessor (bicubic resize of the short side + center crop).
+    With JPEG_DRAFT, JPEGs are decoded at reduced scale in the DCT domain,
+    which is faster but changes pixels slightly. Returns None if decoding fails.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        if JPEG_DRAFT:
+            image.draft("RGB", (IMAGE_SIZE, IMAGE_SIZE))
+        image = ImageOps.fit(image.convert("RGB"), (IMAGE_SIZE, IMAGE_SIZE), Image.Resampling.BICUBIC)
+        return np.asarray(image)
+    except Exception as e:
+        print(f"Error decoding image: {e}")
+        return None
+
+
+def preprocess_images(arrays: List[np.ndarray]) -> torch.Tensor:
+    """
+    Build normalized CLIP pixel values on the device, shape (N, 3, H, W)
+    Images are copied straight into one preallocated (pinned on GPU) uint8
+    batch tensor, which is transferred once and normalized in place.
+    """
+    pixel_values = torch.empty(
+        (len(arrays), 3, IMAGE_SIZE, IMAGE_SIZE), dtype=torch.uint8, pin_memory=device == "cuda"
+    )
+    for i, array in enumerate(arrays):
+        np.copyto(pixel_values[i].permute(1, 2, 0).numpy(), array)
+    
+    pixel_values = pixel_values.to(device, non_blocking=True).float().div_(255)
+    return pixel_values.sub_(PIXEL_MEAN).div_(PIXEL_STD).to(model_dtype)
+
+
+def _bucket_size(n: int) -> int:
+    """Round a batch size up to the next power of two, capped at ENCODE_BATCH_SIZE"""
+    return min(ENCODE_BATCH_SIZE, 1 << (n - 1).bit_length())
+
+
+def _capture_cuda_graph(batch_size: int) -> Tuple["torch.cuda.CUDAGraph", torch.Tensor, torch.Tensor]:
+    """Capture the image tower for a fixed batch size into a CUDA graph"""
+    static_pixels = torch.zeros(
+        (batch_size, 3, IMAGE_SIZE, IMAGE_SIZE), device=device, dtype=model_dtype
+    )
+    
+    # Warm up on a side stream so compilation and allocator setup stay out of the graph
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(3):
+            image_encoder(pixel_values=static_pixels)
+    torch.cuda.current_stream().wait_stream(stream)
+    
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_output = image_encoder(pixel_values=static_pixels)
+    
+    return graph, static_pixels, static_output
+
+
+def encode_images(pixel_values: torch.Tensor) -> torch.Tensor:
+    """
+    Run the CLIP image tower on a batch of pixel values, returning FP32 features
+    Batches are split into chunks of ENCODE_BATCH_SIZE. When the encoder is
+    compiled, chunks are zero-padded up to a power-of-two bucket so it only
+    ever sees a handful of shapes instead of recompiling for every upload
+    size; eager mode runs chunks unpadded. On GPU each bucket replays the
+    CUDA graph captured at startup.
+    """
+    features = []
+    for start in range(0, len(pixel_values), ENCODE_BATCH_SIZE):
+        chunk = pixel_values[start:start + ENCODE_BATCH_SIZE]
+        n = len(chunk)
+        bucket = _bucket_size(n)
+        
+        if use_cuda_graphs:
+            # Static buffers are shared, so copy in, replay and copy out under the lock
+            with _cuda_graph_lock:
+                graph, static_pixels, static_output = _cuda_graphs[bucket]
+                static_pixels[:n].copy_(chunk)
+                static_pixels[n:].zero_()
+                graph.replay()
+                features.append(static_output[:n].float().clone())
+            continue
+        
+        if fixed_shapes and bucket > n:
+            chunk = torch.cat([chunk, chunk.new_zeros((bucket - n, *chunk.shape[1:]))])
+        
+        with torch.autocast(device_type=device, dtype=autocast_dtype, enabled=use_autocast):
+            output = image_encoder(pixel_values=chunk)
+        
+        features.append(output[:n].float())
+    
+    return torch.cat(features)
+
+
+def warm_up_image_encoder():
+    """
+    Run every batch bucket once so compilation never happens on the request path
+    With CUDA graphs, each bucket is captured here, before any request thread
+    can issue GPU work that would break a capture.
+    """
+    buckets = sorted({_bucket_size(n) for n in range(1, ENCODE_BATCH_SIZE + 1)})
+    print(f"Warming up image encoder for batch sizes {buckets}...")
+    with torch.inference_mode():
+        for bucket in buckets:
+            if use_cuda_graphs:
+                _cuda_graphs[bucket] = _capture_cuda_graph(bucket)
+            else:
+                encode_images(torch.zeros(
+                    (bucket, 3, IMAGE_SIZE, IMAGE_SIZE), device=device, dtype=model_dtype
+                ))
+
+
+if compiled or use_cuda_graphs:
+    warm_up_image_encoder()
+
+
+def _cache_get_image_features(key: str) -> Optional[torch.Tensor]:
+    """Look up cached image features by content hash"""
+    with _image_feat_lock:
+        features = _image_feat_cache.get(key)
+        if features is not None:
+            _image_feat_cache.move_to_end(key)
+        return features
+
+
+def _cache_put_image_features(key: str, features: torch.Tensor):
+    """Store image features, evicting the least recently used entries"""
+    # Clone so the entry does not keep its whole batch tensor alive
+    features = features.clone()
+    with _image_feat_lock:
+        _image_feat_cache[key] = features
+        _image_feat_cache.move_to_end(key)
+        while len(_image_feat_cache) > IMAGE_CACHE_SIZE:
+            _image_feat_cache.popitem(last=False)
+
+
+def predict_labels_batch(images_data: List[bytes], labels: List[str], project_id: int) -> List[Dict[str, float]]:
+    """
+    Use CLIP to predict label probabilities for a batch of in-memory images
+    Text features come from the per-project cache, and images whose content
+    was seen before reuse their cached embedding instead of re-running the
+    image tower.
+    Returns one {"label1": 0.8, "label2": 0.15, ...} per image,
+    or {} for images that could not be decoded.
+    """
+    results: List[Dict[str, float]] = [{} for _ in images_data]
+    features: List[Optional[torch.Tensor]] = [None for _ in images_data]
+    
+    # Images to encode, grouped by content hash so duplicates encode once
+    pending: Dict[str, List[int]] = {}
+    pending_data = []
+    for i, data in enumerate(images_data):
+        key = hashlib.blake2b(data, digest_size=16).hexdigest()
+        
+        cached = _cache_get_image_features(key)
+        if cached is not None:
+            features[i] = cached
+        elif key in pending:
+            pending[key].append(i)
+        else:
+            pending[key] = [i]
+            pending_data.append(data)
+    
+    try:
+        text_features = get_text_features(project_id, labels)
+        
+        with torch.inference_mode():
+            # Decode in the pool while earlier chunks run through CLIP
+            decoded = zip(pending.items(), PREPROC_POOL.map(load_image, pending_data))
+            while True:
+                chunk = list(islice(decoded, PREPROC_CHUNK_SIZE))
+                if not chunk:
+                    break
+                chunk = [(item, array) for item, array in chunk if array is not None]
+                if not chunk:
+                    continue
+                
+                # Prepare inputs
+                pixel_values = preprocess_images([array for _, array in chunk])
+                
+                image_features = encode_images(pixel_values)
+                image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+                image_features = image_features.half().cpu()
+                
+                for ((key, indices), _), feature in zip(chunk, image_features):
+                    _cache_put_image_features(key, feature)
+                    for i in indices:
+                        features[i] = feature
+            
+            indices = [i for i, feature in enumerate(features) if feature is not None]
+            if not indices:
+                return results
+            
+            # Get predictions as a single GEMM against the cached text features, shape (N, L)
+            image_features = torch.stack([features[i] for i in indices])
+            image_features = image_features.to(device, dtype=feature_dtype, non_blocking=True)
+            logits_per_image = torch.mm(image_features, text_features.T).float().mul_(logit_scale)
+            probs = logits_per_image.softmax(dim=1).cpu().numpy()
         
-        # Return label:probability mapping
-        predictions = {label: float(prob) for label, prob in zip(labels, probs)}
-        return predictions
+        # Return label:probability mapping per image
+        for i, row in zip(indices, probs):
+            results[i] = {label: float(prob) for label, prob in zip(labels, row)}
     
     except Exception as e:
-        print(f"Error predicting label: {e}")
-        return {}
+        print(f"Error predicting labels: {e}")
+    
+    return results
 
 
 # Routes
 
+@app.errorhandler(queue.Empty)
+def database_busy(e):
+    """No pooled read connection became free in time"""
+    return jsonify({"error": "Database busy, try again"}), 503
+
+
 @app.route("/health", methods=["GET"])
 def health():
     """Health check endpoint"""
@@ -120,24 +509,22 @@ def health():
 @app.route("/projects", methods=["GET", "POST"])
 def projects():
     """List or create projects"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
     if request.method == "GET":
-        cursor.execute("SELECT id, name, labels, created_at FROM projects ORDER BY created_at DESC")
-        rows = cursor.fetchall()
+        with _read_conn() as conn:
+            rows = conn.execute(
+                "SELECT id, name, labels, created_at FROM projects ORDER BY created_at DESC"
+            ).fetchall()
         
         projects_list = [
             {
                 "id": row[0],
                 "name": row[1],
-                "labels": json.loads(row[2]),
+                "labels": _parse_labels(row[0], row[2]),
                 "created_at": row[3]
             }
             for row in rows
         ]
         
-        conn.close()
         return jsonify({"projects": projects_list})
     
     # POST - create new project
@@ -148,13 +535,20 @@ def projects():
     if not name or not labels:
         return jsonify({"error": "Missing name or labels"}), 400
     
-    cursor.execute(
-        "INSERT INTO projects (name, labels) VALUES (?, ?)",
-        (name, json.dumps(labels))
-    )
-    conn.commit()
-    project_id = cursor.lastrowid
-    conn.close()
+    with _write_txn() as conn:
+        cursor = conn.execute(
+            "INSERT INTO projects (name, labels) VALUES (?, ?)",
+            (name, orjson.dumps(labels).decode())
+        )
+        project_id = cursor.lastrowid
+    
+    _project_labels[project_id] = labels
+    
+    # Warm the text feature cache so the first upload only runs the image tower
+    try:
+        get_text_features(project_id, labels)
+    except Exception as e:
+        print(f"Error encoding labels: {e}")
     
     return jsonify({"id": project_id, "name": name, "labels": labels}), 201
 
@@ -166,91 +560,140 @@ def upload_images(project_id: int):
         return jsonify({"error": "No files provided"}), 400
     
     files = request.files.getlist("files")
+    if len(files) > MAX_UPLOAD_FILES:
+        return jsonify({"error": f"Too many files (max {MAX_UPLOAD_FILES})"}), 400
     
     # Get project labels
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT labels FROM projects WHERE id = ?", (project_id,))
-    row = cursor.fetchone()
-    
-    if not row:
-        conn.close()
-        return jsonify({"error": "Project not found"}), 404
-    
-    labels = json.loads(row[0])
+    labels = _project_labels.get(project_id)
+    if labels is None:
+        with _read_conn() as conn:
+            row = conn.execute("SELECT labels FROM projects WHERE id = ?", (project_id,)).fetchone()
+        
+        if not row:
+            return jsonify({"error": "Project not found"}), 404
+        
+        labels = _parse_labels(project_id, row[0])
     
-    uploaded = []
+    # Read valid files into memory so the whole batch can be labeled at once
+    saved = []
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     for file in files:
         if file and allowed_file(file.filename):
+            # Check size and magic bytes before reading the whole file
+            size = file.stream.seek(0, os.SEEK_END)
+            file.stream.seek(0)
+            if size > MAX_FILE_SIZE or not is_image_header(file.stream.read(12)):
+                continue
+            file.stream.seek(0)
+            
             filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            unique_filename = f"{timestamp}_{filename}"
+            # Random suffix keeps same-second uploads of one filename apart
+            unique_filename = f"{timestamp}_{secrets.token_hex(4)}_{filename}"
             
             filepath = UPLOAD_FOLDER / unique_filename
-            file.save(filepath)
-            
-            # Run ML prediction
-            predictions = predict_label(str(filepath), labels)
-            
-            # Get top prediction
-            if predictions:
-                top_label = max(predictions, key=predictions.get)
-                confidence = predictions[top_label]
-            else:
-                top_label = None
-                confidence = None
-            
-            # Save to database
-            cursor.execute(
+            saved.append((filename, filepath, file.stream.read()))
+    
+    # Run ML prediction straight from the uploaded bytes
+    batch_predictions = predict_labels_batch(
+        [data for _, _, data in saved], labels, project_id
+    )
+    
+    uploaded = []
+    rows = []
+    
+    for (filename, filepath, data), predictions in zip(saved, batch_predictions):
+        filepath.write_bytes(data)
+        
+        # Get top prediction
+        if predictions:
+            top_label = max(predictions, key=predictions.get)
+            confidence = predictions[top_label]
+        else:
+            top_label = None
+            confidence = None
+        
+        rows.append((project_id, filename, str(filepath), top_label, confidence))
+        uploaded.append({
+            "filename": filename,
+            "label": top_label,
+            "confidence": confidence,
+            "predictions": predictions
+        })
+    
+    # Save to database in one transaction; a single executemany under the
+    # write lock assigns contiguous rowids ending at last_insert_rowid()
+    if rows:
+        with _write_txn() as conn:
+            conn.executemany(
                 """INSERT INTO images (project_id, filename, filepath, label, confidence)
                    VALUES (?, ?, ?, ?, ?)""",
-                (project_id, filename, str(filepath), top_label, confidence)
+                rows
             )
-            
-            uploaded.append({
-                "id": cursor.lastrowid,
-                "filename": filename,
-                "label": top_label,
-                "confidence": confidence,
-                "predictions": predictions
-            })
-    
-    conn.commit()
-    conn.close()
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        
+        first_id = last_id - len(rows) + 1
+        for offset, image in enumerate(uploaded):
+            image["id"] = first_id + offset
     
     return jsonify({"uploaded": uploaded})
 
 
 @app.route("/projects/<int:project_id>/images", methods=["GET"])
 def get_images(project_id: int):
-    """Get all images for a project"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT id, filename, filepath, label, confidence, is_verified
-        FROM images
-        WHERE project_id = ?
-        ORDER BY created_at DESC
-    """, (project_id,))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
-    images = [
-        {
-            "id": row[0],
-            "filename": row[1],
-            "filepath": row[2],
-            "label": row[3],
-            "confidence": row[4],
-            "is_verified": bool(row[5])
-        }
-        for row in rows
-    ]
-    
-    return jsonify({"images": images})
+    """
+    Get a page of images for a project, newest first, as NDJSON
+    Query params: limit (default 100, max 500), and either offset or
+    before=<image id> for keyset pagination that stays fast on deep pages.
+    """
+    try:
+        limit = min(int(request.args.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        offset = int(request.args.get("offset", 0))
+        before = request.args.get("before")
+        if before is not None:
+            before = int(before)
+    except ValueError:
+        return jsonify({"error": "Invalid pagination parameters"}), 400
+    
+    if limit < 0 or not 0 <= offset <= MAX_SQLITE_INT:
+        return jsonify({"error": "Invalid pagination parameters"}), 400
+    
+    if before is not None:
+        if not 0 <= before <= MAX_SQLITE_INT:
+            return jsonify({"error": "Invalid pagination parameters"}), 400
+        if "offset" in request.args:
+            return jsonify({"error": "Use either offset or before, not both"}), 400
+    
+    with _read_conn() as conn:
+        if before is not None:
+            rows = conn.execute("""
+                SELECT id, filename, filepath, label, confidence, is_verified
+                FROM images
+                WHERE project_id = ? AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            """, (project_id, before, limit)).fetchall()
+        else:
+            rows = conn.execute("""
+                SELECT id, filename, filepath, label, confidence, is_verified
+                FROM images
+                WHERE project_id = ?
+                ORDER BY id DESC
+                LIMIT ? OFFSET ?
+            """, (project_id, limit, offset)).fetchall()
+    
+    def generate():
+        for row in rows:
+            yield orjson.dumps({
+                "id": row[0],
+                "filename": row[1],
+                "filepath": row[2],
+                "label": row[3],
+                "confidence": row[4],
+                "is_verified": bool(row[5])
+            }) + b"\n"
+    
+    return Response(generate(), mimetype="application/x-ndjson")
 
 
 @app.route("/images/<int:image_id>/label", methods=["PUT"])
@@ -263,75 +706,91 @@ def update_label(image_id: int):
     if not label:
         return jsonify({"error": "Missing label"}), 400
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "UPDATE images SET label = ?, is_verified = ? WHERE id = ?",
-        (label, is_verified, image_id)
-    )
-    
-    conn.commit()
-    conn.close()
+    with _write_txn() as conn:
+        conn.execute(
+            "UPDATE images SET label = ?, is_verified = ? WHERE id = ?",
+            (label, is_verified, image_id)
+        )
     
     return jsonify({"success": True})
 
 
 @app.route("/projects/<int:project_id>/export", methods=["GET"])
 def export_labels(project_id: int):
-    """Export labels as JSON"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
+    """Export labels as JSON, streamed row by row"""
     # Get project info
-    cursor.execute("SELECT name, labels FROM projects WHERE id = ?", (project_id,))
-    project_row = cursor.fetchone()
+    with _read_conn() as conn:
+        project_row = conn.execute(
+            "SELECT name, labels FROM projects WHERE id = ?", (project_id,)
+        ).fetchone()
     
     if not project_row:
-        conn.close()
         return jsonify({"error": "Project not found"}), 404
     
     project_name, labels_json = project_row
     
-    # Get images
-    cursor.execute("""
-        SELECT filename, filepath, label, confidence, is_verified
-        FROM images
-        WHERE project_id = ?
-    """, (project_id,))
-    
-    rows = cursor.fetchall()
-    conn.close()
-    
-    export_data = {
-        "project": {
-            "name": project_name,
-            "labels": json.loads(labels_json)
-        },
-        "images": [
-            {
-                "filename": row[0],
-                "filepath": row[1],
-                "label": row[2],
-                "confidence": row[3],
-                "is_verified": bool(row[4])
-            }
-            for row in rows
-        ],
-        "summary": {
-            "total_images": len(rows),
-            "verified": sum(1 for row in rows if row[4]),
-            "unverified": sum(1 for row in rows if not row[4])
+    def generate():
+        project = {"name": project_name, "labels": _parse_labels(project_id, labels_json)}
+        yield b'{"project":' + orjson.dumps(project) + b',"images":['
+        
+        # Use a dedicated connection: a slow download must not hold a pooled
+        # reader for the whole response
+        conn = _connect()
+        try:
+            # One read transaction so images and summary see the same snapshot
+            conn.execute("BEGIN")
+            try:
+                # Get images
+                cursor = conn.execute("""
+                    SELECT filename, filepath, label, confidence, is_verified
+                    FROM images
+                    WHERE project_id = ?
+                """, (project_id,))
+                cursor.arraysize = EXPORT_FETCH_SIZE
+                
+                separator = b""
+                while True:
+                    rows = cursor.fetchmany()
+                    if not rows:
+                        break
+                    
+                    yield separator + b",".join(
+                        orjson.dumps({
+                            "filename": row[0],
+                            "filepath": row[1],
+                            "label": row[2],
+                            "confidence": row[3],
+                            "is_verified": bool(row[4])
+                        })
+                        for row in rows
+                    )
+                    separator = b","
+                
+                # Get summary
+                total, verified = conn.execute("""
+                    SELECT COUNT(*), COUNT(*) FILTER (WHERE is_verified)
+                    FROM images
+                    WHERE project_id = ?
+                """, (project_id,)).fetchone()
+            finally:
+                conn.execute("COMMIT")
+        finally:
+            conn.close()
+        
+        summary = {
+            "total_images": total,
+            "verified": verified,
+            "unverified": total - verified
         }
-    }
+        yield b'],"summary":' + orjson.dumps(summary) + b"}"
     
-    return jsonify(export_data)
+    return Response(stream_with_context(generate()), mimetype="application/json")
 
 
 @app.route("/uploads/<path:filename>", methods=["GET"])
 def serve_image(filename):
-    """Serve uploaded images"""
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    """Serve uploaded images (cacheable, with ETag / 304 support)"""
+    return send_from_directory(UPLOAD_FOLDER, filename, conditional=True, max_age=IMAGE_MAX_AGE)
 
 
 if __name__ == "__main__":